@@ -1,46 +1,96 @@
 #!/usr/bin/env python3
 
-import json
-import csv
 import os
+import re
+import sys
 import logging
 import random
 
+import ujson
+import pandas as pd
+
+from array import array
 from pathlib import Path
-from collections import defaultdict, namedtuple
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 logger = logging.getLogger(__name__)
 
 DataTriple = namedtuple('DataTriple', ['subj', 'pred', 'obj'])
 
+# number of csv rows parsed at once when streaming E2E splits
+CSV_CHUNKSIZE = 65536
+
+# one `key[value]` slot of an E2E meaning representation, e.g. "name[The Vaults], eatType[pub]"
+MR_SLOT_PATTERN = re.compile(r"\s*([^,\[]*)\[([^\]]*)\]")
+
+
+# dataset classes by their lower-case name, filled by @register_dataset at import time
+DATASET_REGISTRY = {}
+
+
+def register_dataset(cls):
+    """
+    Class decorator making the dataset available through get_dataset_class under its `name`
+    """
+    DATASET_REGISTRY[cls.name.lower()] = cls
+    return cls
+
 
 def get_dataset_class(dataset_class):
     """
     A wrapper for easier introduction of new datasets.
     Returns class "MyDataset" for a parameter "--dataset mydataset"
     """
-    try:
-        # case-insensitive
-        available_classes = {o.name.lower(): o for o in globals().values()
-                             if type(o) == type(D2TDataset) and hasattr(o, "name")}
-        return available_classes[dataset_class.lower()]
-    except AttributeError:
-        logger.error(f"Unknown dataset: '{dataset_class}'. Please create \
-            a class with an attribute name='{dataset_class}' in 'data.py'.")
-        return None
+    # case-insensitive
+    dataset_cls = DATASET_REGISTRY.get(dataset_class.lower())
+
+    if dataset_cls is None:
+        logger.error(f"Unknown dataset: '{dataset_class}'. Please create a class with an attribute "
+                     f"name='{dataset_class}' decorated by @register_dataset in 'datasetclasses.py'.")
+
+    return dataset_cls
+
+
+class LexView:
+    """
+    Read-only sequence of lexicalizations stored as indices into a shared pool of reference texts.
+    The `{"text": ...}` dicts are only created on access.
+    """
+    __slots__ = ('pool', 'indices')
+
+    def __init__(self, pool, indices):
+        self.pool = pool
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __iter__(self):
+        pool = self.pool
+        return ({"text": pool[i]} for i in self.indices)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [{"text": self.pool[i]} for i in self.indices[idx]]
+        return {"text": self.pool[self.indices[idx]]}
+
+    def __repr__(self):
+        return repr(list(self))
 
 
 class DataEntry:
     """
     A single D2T dataset example: a set of triples & its possible lexicalizations
     """
+    __slots__ = ('triples', 'lexs')
 
     def __init__(self, triples, lexs):
         self.triples = triples
         self.lexs = lexs
 
     def __repr__(self):
-        return str(self.__dict__)
+        return f"DataEntry(triples={self.triples!r}, lexs={self.lexs!r})"
 
 
 class D2TDataset:
@@ -64,16 +114,33 @@ class D2TDataset:
             return
 
         logger.info(f"Loaded templates from {templates_filename}")
-        with open(templates_filename) as f:
-            self.templates = json.load(f)
+        self.templates = ujson.loads(Path(templates_filename).read_bytes())
 
 
+@register_dataset
 class E2E(D2TDataset):
     name = "e2e"
 
     def __init__(self):
         super().__init__()
 
+    def load_templates(self, templates_filename):
+        """
+        Load existing templates from a JSON file and flatten them for get_template
+        """
+        super().load_templates(templates_filename)
+
+        self.templates_by_pred_obj = {}
+        self.templates_by_pred = {}
+
+        for pred, templates in getattr(self, "templates", {}).items():
+            # special templates for familyFriendly yes / no
+            if type(templates) is dict:
+                for obj, obj_templates in templates.items():
+                    self.templates_by_pred_obj[(pred, obj)] = obj_templates[0]
+            else:
+                self.templates_by_pred[pred] = templates[0]
+
     def load_from_dir(self, path, template_path, splits):
         """
         Load the dataset
@@ -82,32 +149,55 @@ class E2E(D2TDataset):
 
         for split in splits:
             logger.info(f"Loading {split} split")
-            triples_to_lex = defaultdict(list)
+            # reference texts are kept in one pool, entries only store indices into it
+            pool = []
+            triples_to_lex = {}
+            # every mr repeats for each of its references -> remember its lex indices (None if skipped)
+            # together with the corrupted flag, so that it is parsed and hashed as triples only once
+            mr_to_lex = {}
+
+            # columns are pre-typed so that pandas skips type inference, the csv is streamed in chunks
+            with pd.read_csv(os.path.join(path, f"{split}.csv"), usecols=[0, 1], dtype="string",
+                             chunksize=CSV_CHUNKSIZE, engine="c", quotechar='"',
+                             keep_default_na=False, na_filter=False) as csv_reader:
+                err = 0
 
-            with open(os.path.join(path, f"{split}.csv")) as csv_file:
-                csv_reader = csv.reader(csv_file, delimiter=',', quotechar='"')
+                # bind attributes used for every row to locals
+                entries = self.data[split]
+                mr_to_triples = self._mr_to_triples
+                pool_append = pool.append
 
-                # skip header
-                next(csv_reader)
-                err = 0
+                for chunk in csv_reader:
+                    mrs = chunk.iloc[:, 0].to_numpy()
+                    refs = chunk.iloc[:, 1].to_numpy()
+
+                    for mr, ref in zip(mrs, refs):
+                        cached = mr_to_lex.get(mr)
 
-                for i, line in enumerate(csv_reader):
-                    triples = self._mr_to_triples(line[0])
+                        if cached is None:
+                            triples = mr_to_triples(mr)
+                            # probably a corrupted sample
+                            corrupted = not triples or len(triples) == 1
 
-                    # probably a corrupted sample
-                    if not triples or len(triples) == 1:
-                        err += 1
-                        # cannot skip for dev and test
-                        if split == "train":
-                            continue
+                            # cannot skip for dev and test
+                            if corrupted and split == "train":
+                                lex_indices = None
+                            # different mrs can still give the same triples, entries are created on first sight
+                            else:
+                                lex_indices = triples_to_lex.get(triples)
 
-                    lex = {"text": line[1]}
-                    triples_to_lex[triples].append(lex)
+                                if lex_indices is None:
+                                    lex_indices = triples_to_lex[triples] = array('i')
+                                    entries.append(DataEntry(triples, LexView(pool, lex_indices)))
 
-                # triples are not sorted, complete entries can be created only after the dataset is processed
-                for triples, lex_list in triples_to_lex.items():
-                    entry = DataEntry(triples, lex_list)
-                    self.data[split].append(entry)
+                            cached = mr_to_lex[mr] = (corrupted, lex_indices)
+
+                        corrupted, lex_indices = cached
+                        err += corrupted
+
+                        if lex_indices is not None:
+                            lex_indices.append(len(pool))
+                            pool_append(ref)
 
             logger.warn(f"{err} corrupted instances")
 
@@ -115,49 +205,38 @@ class E2E(D2TDataset):
         """
         Transforms E2E meaning representation into RDF triples.
         """
-        triples = []
-
         # cannot be dictionary, slot keys can be duplicated
-        items = [x.strip() for x in mr.split(",")]
+        # the whole mr is scanned at once by the regex engine instead of splitting and stripping each slot
+        slots = MR_SLOT_PATTERN.findall(mr)
         subj = None
 
-        keys = []
-        vals = []
+        # the slot keys come from a small vocabulary -> share one string object per key across all triples
+        keys = [sys.intern(key) for key, _ in slots]
 
-        for item in items:
-            key, val = item.split("[")
-            val = val[:-1]
-
-            keys.append(key)
-            vals.append(val)
-
-        name_idx = None if "name" not in keys else keys.index("name")
-        eatType_idx = None if "eatType" not in keys else keys.index("eatType")
+        # the subject slot is skipped when emitting the triples instead of being deleted from the lists
+        subj_idx = None
 
         # primary option: use `name` as a subject
-        if name_idx is not None:
-            subj = vals[name_idx]
-            del keys[name_idx]
-            del vals[name_idx]
-
-            # corrupted case hotfix
-            if not keys:
-                keys.append("eatType")
-                vals.append("restaurant")
-
+        if "name" in keys:
+            subj_idx = keys.index("name")
         # in some cases, that does not work -> use `eatType` as a subject
-        elif eatType_idx is not None:
-            subj = vals[eatType_idx]
-            del keys[eatType_idx]
-            del vals[eatType_idx]
+        elif "eatType" in keys:
+            subj_idx = keys.index("eatType")
+
+        if subj_idx is not None:
+            subj = slots[subj_idx][1]
         # still in some cases, there is not even an eatType
         # -> hotfix so that we do not lose data
         else:
             # logger.warning(f"Cannot recognize subject in mr: {mr}")
             subj = "restaurant"
 
-        for key, val in zip(keys, vals):
-            triples.append(DataTriple(subj, key, val))
+        triples = [DataTriple(subj, key, val) for idx, (key, (_, val)) in enumerate(zip(keys, slots))
+                   if idx != subj_idx]
+
+        # corrupted case hotfix
+        if not triples and subj_idx is not None and keys[subj_idx] == "name":
+            triples.append(DataTriple(subj, "eatType", "restaurant"))
 
         # will be used as a key in a dictionary
         return tuple(triples)
@@ -166,19 +245,15 @@ class E2E(D2TDataset):
         """
         Return the template for the triple
         """
-        if triple.pred in self.templates:
-            templates = self.templates[triple.pred]
-            # special templates for familyFriendly yes / no
-            if type(templates) is dict and triple.obj in templates:
-                template = templates[triple.obj][0]
-            else:
-                template = templates[0]
-        else:
-            template = self.fallback_template
+        template = self.templates_by_pred_obj.get((triple.pred, triple.obj))
+
+        if template is None:
+            template = self.templates_by_pred.get(triple.pred, self.fallback_template)
 
         return template
 
 
+@register_dataset
 class WikiData(D2TDataset):
     name = "wikidata"
 
@@ -190,16 +265,27 @@ class WikiData(D2TDataset):
         Return the template for the triple
         """
         pred = triple.pred
+        templates = self.templates.get(pred)
 
-        if pred in self.templates:
+        if templates is not None:
             # Note: Sampling one of available templates from list
-            template = random.sample(self.templates[pred], 1)[0]
+            template = random.choice(templates)
         else:
             logger.warning(f"No template for {pred}, using a fallback")
             template = self.fallback_template
 
         return template
 
+    def load_templates(self, templates_filename):
+        """
+        Load existing templates from a JSON file, wrapping single templates in a list
+        """
+        super().load_templates(templates_filename)
+
+        if hasattr(self, "templates"):
+            self.templates = {pred: templates if isinstance(templates, list) else [templates]
+                              for pred, templates in self.templates.items()}
+
     # TODO: this is stage III, implement this after stage I and II are finished
     def load_from_dir(self, path, template_path, splits):
         """
@@ -217,10 +303,11 @@ class WikiData(D2TDataset):
             err = 0
 
             entryset = self._load_jsons_from_dir(data_dir)
+            make_triple = DataTriple._make
 
             for entry_list in entryset:
-                triples = [DataTriple(e[0], e[1], e[2]) for e in
-                           entry_list]  # Refactor: populate triples with triples from entryset wrapped by DataTriple
+                # entries are already (sid, rid, oid) tuples -> wrap them by DataTriple without argument unpacking
+                triples = list(map(make_triple, entry_list))
                 lexs = self._extract_lexs(entry_list, None)
 
                 if not any([lex for lex in lexs]):
@@ -233,36 +320,40 @@ class WikiData(D2TDataset):
             if err > 0:
                 logger.warning(f"Skipping {err} entries without lexicalizations...")
 
-    def _load_jsons_from_dir(self, data_dir: str or Path) -> list[list[tuple]]:
+    def _load_jsons_from_dir(self, data_dir: str or Path, max_workers: int = None) -> list[list[tuple]]:
         """ Loads all json files from data_dir and parses their content into one list of lists of string tuples
         containing their sid, rid, and oid.
             The input json files have structure:
             {"data": [["(sid | rid | oid)", "(sid | rid | oid)", ...]]}
             The output list has structure:
             [[("sid", "rid", "oid"), ("sid", "rid", "oid"), ...], [...], ...]
+        The files are read and parsed in a thread pool of `max_workers` threads.
         """
         data_d = Path(data_dir)
-        files = data_d.glob("**/*.json")
+        files = data_d.rglob("*.json")
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            final_list = list(executor.map(self._load_json, files))
 
-        final_list = []
-        for file in files:
-            print(file)
-            data = json.load(file.open("r"))["data"]
+        return final_list
 
-            # Create a temporary list to store tuples of sid, rid, and oid for each file
-            temp_list = []
+    @staticmethod
+    def _load_json(file: Path) -> list[tuple]:
+        """ Parses one json file into a list of (sid, rid, oid) string tuples
+        """
+        data = ujson.loads(file.read_bytes())["data"]
 
-            for item in data[0]:
-                # Split the string using the "|" character and strip any leading/trailing whitespace
-                sid, rid, oid = map(str.strip, item.split("|"))
+        # Create a temporary list to store tuples of sid, rid, and oid for each file
+        temp_list = []
 
-                # Create a tuple and add it to the temporary list
-                temp_list.append((sid, rid, oid))
+        for item in data[0]:
+            # Split the string using the "|" character and strip any leading/trailing whitespace
+            sid, rid, oid = item.split("|")
 
-            # Add the temporary list to the final list
-            final_list.append(temp_list)
+            # Create a tuple and add it to the temporary list
+            temp_list.append((sid.strip(), rid.strip(), oid.strip()))
 
-        return final_list
+        return temp_list
 
     def _extract_lexs(self, lex_entries, triples=None):
         """